@@ -0,0 +1,210 @@
+# agent.py
+
+import orjson
+import asyncio
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from payments_py.data_models import AgentExecutionStatus, TaskLog
+from utils.utils import upload_image_and_get_url
+
+# Number of IPFS URLs of previously generated characters kept for reuse
+IMAGE_CACHE_SIZE = 256
+
+class ImageGeneratorAgent:
+    """
+    An agent that uses the ImageGenerator class and Nevermined's Payments API to generate images.
+    """
+
+    def __init__(self, payment, image_generator):
+        """
+        Initialize the ImageGeneratorAgent with a Payments instance and an ImageGenerator instance.
+
+        Args:
+            payment (Payments): The Payments instance for interacting with Nevermined's API.
+            image_generator (ImageGenerator): The ImageGenerator instance for generating images.
+        """
+        self.payment = payment
+        self.image_generator = image_generator
+        self.queue = asyncio.Queue()
+        # Run generation on a single dedicated thread so the event loop stays responsive
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # LRU cache of character prompt hash -> IPFS URL of its generated image
+        self.image_cache = OrderedDict()
+
+    async def process_queue(self):
+        """
+        Feed queued generation requests into the image generator's stream batch and
+        resolve the future attached to each request with its image.
+
+        Every tick advances all in-flight requests by one denoising step, and new
+        requests join on the next tick instead of waiting for the current ones to finish.
+
+        Returns:
+            None
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            # Wait for work when nothing is being denoised
+            if not self.image_generator.inflight:
+                await self._admit(await self.queue.get())
+
+            # Admit requests that arrived during the last tick while there are free slots
+            while not self.queue.empty() and len(self.image_generator.inflight) < self.image_generator.max_inflight:
+                await self._admit(self.queue.get_nowait())
+
+            if not self.image_generator.inflight:
+                continue
+
+            try:
+                finished = await loop.run_in_executor(self.executor, self.image_generator.step)
+            except Exception as e:
+                # A failed tick leaves every in-flight request in an unknown state
+                for slot in self.image_generator.inflight:
+                    if not slot.request.done():
+                        slot.request.set_exception(e)
+                self.image_generator.inflight.clear()
+                continue
+
+            for future, image in finished:
+                if not future.done():
+                    future.set_result(image)
+
+    async def _admit(self, item):
+        """
+        Add a queued request to the image generator's stream batch.
+
+        Args:
+            item (tuple[str, asyncio.Future]): The character prompt and the future to resolve.
+
+        Returns:
+            None
+        """
+        character_prompt, future = item
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.image_generator.add_request, character_prompt, future
+            )
+        except Exception as e:
+            future.set_exception(e)
+
+    async def generate_image(self, character_prompt):
+        """
+        Queue a character prompt for generation and wait for its image.
+
+        Args:
+            character_prompt (str): The character description to generate an image for.
+
+        Returns:
+            PIL.Image.Image: The generated image.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((character_prompt, future))
+        return await future
+
+    async def run(self, data):
+        """
+        Process incoming data to generate images and update task status via Nevermined's API.
+
+        Args:
+            data (dict): A dictionary containing task and step information.
+
+        Returns:
+            None
+        """
+
+        # Retrieve the current step information using the step_id from data
+        step = self.payment.ai_protocol.get_step(data['step_id'])
+
+        # Check if the step status is pending; if not, exit the function
+        if step['step_status'] != AgentExecutionStatus.Pending.value:
+            return
+
+        # Log the initiation of the image generation task
+        await self.payment.ai_protocol.log_task(TaskLog(
+            task_id=step['task_id'],
+            message='Starting image generation...',
+            level='info'
+        ))
+
+        # Extract the character object from input_query
+        input_query = step.get('input_query', '')
+
+        # If the input query is a JSON object, convert it to a string with key value pairs separated by new lines
+        try:
+            character_prompt_dict = orjson.loads(input_query)
+        except (orjson.JSONDecodeError, TypeError):
+            character_prompt_dict = None
+
+        if isinstance(character_prompt_dict, dict):
+            character_prompt = '\n'.join(f"{k}: {v}" for k, v in character_prompt_dict.items())
+        else:
+            character_prompt = input_query if isinstance(input_query, str) else ''
+
+        if not character_prompt:
+            print("No character data provided")
+            await self.payment.ai_protocol.log_task(TaskLog(
+                task_id=step['task_id'],
+                message='No character data provided.',
+                level='error',
+                task_status=AgentExecutionStatus.Failed
+            ))
+            return
+
+        try:
+            # Generation is deterministic, so a character that was already generated reuses its image
+            cache_key = hashlib.blake2b(character_prompt.encode(), digest_size=16).hexdigest()
+            ipfs_url = self.image_cache.get(cache_key)
+
+            if ipfs_url is not None:
+                self.image_cache.move_to_end(cache_key)
+                print("Reusing cached image for character")
+            else:
+                # Use the ImageGenerator instance to generate the image
+                image = await self.generate_image(character_prompt)
+
+                # Upload the image to IPFS off the event loop and get the public URL
+                ipfs_url = await asyncio.to_thread(upload_image_and_get_url, image, name=data['task_id'])
+
+                self.image_cache[cache_key] = ipfs_url
+                if len(self.image_cache) > IMAGE_CACHE_SIZE:
+                    self.image_cache.popitem(last=False)
+            print("IPFS URL:", ipfs_url)
+
+            # Update the task step with the image data and mark it as completed
+            response = self.payment.ai_protocol.update_step(
+                did=data['did'],
+                task_id=data['task_id'],
+                step_id=data['step_id'],
+                step={
+                    'step_id': data['step_id'],
+                    'task_id': data["task_id"],
+                    'step_status': AgentExecutionStatus.Completed,
+                    'output': 'Image generated and uploaded to IPFS',
+                    'is_last': True,
+                    'output_artifacts': [ipfs_url],
+                },
+            )
+
+            print(response.status_code)
+
+            # Log the completion of the image generation task
+            await self.payment.ai_protocol.log_task(TaskLog(
+                task_id=step['task_id'],
+                message='Image generation and upload to IPFS completed.',
+                level='info',
+                task_status=AgentExecutionStatus.Completed
+            ))
+
+
+        except Exception as e:
+            # Handle any exceptions that occur during the image generation process
+            print("Error during image generation:", e)
+            # Log the error and update the task status to 'Failed'
+            await self.payment.ai_protocol.log_task(TaskLog(
+                task_id=step['task_id'],
+                message=f'Error during image generation: {e}',
+                level='error',
+                task_status=AgentExecutionStatus.Failed
+            ))
+            return
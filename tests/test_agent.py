@@ -0,0 +1,230 @@
+import asyncio
+import contextlib
+from types import SimpleNamespace
+
+import pytest
+from payments_py.data_models import AgentExecutionStatus
+
+import agent as agent_module
+from agent import ImageGeneratorAgent
+
+
+class FakeSlot:
+    def __init__(self, character, request, ticks):
+        self.character = character
+        self.request = request
+        self.remaining = ticks
+
+
+class FakeImageGenerator:
+    """
+    Stand-in for ImageGenerator's stream batch: each request finishes after a fixed number of ticks.
+    """
+
+    def __init__(self, max_inflight=2, ticks=2):
+        self.inflight = []
+        self.max_inflight = max_inflight
+        self.ticks = ticks
+        self.prompts = []
+        self.batch_sizes = []
+        self.fail_next_step = False
+
+    def add_request(self, character, request=None):
+        if character == "bad":
+            raise ValueError("cannot encode prompt")
+        self.prompts.append(character)
+        self.inflight.append(FakeSlot(character, request, self.ticks))
+
+    def step(self):
+        self.batch_sizes.append(len(self.inflight))
+        if self.fail_next_step:
+            self.fail_next_step = False
+            raise RuntimeError("tick failed")
+
+        for slot in self.inflight:
+            slot.remaining -= 1
+        finished = [slot for slot in self.inflight if slot.remaining == 0]
+        self.inflight = [slot for slot in self.inflight if slot.remaining > 0]
+        return [(slot.request, f"image of {slot.character}") for slot in finished]
+
+
+class FakeAIProtocol:
+    def __init__(self, steps):
+        self.steps = steps
+        self.logs = []
+        self.updates = []
+
+    def get_step(self, step_id):
+        return self.steps[step_id]
+
+    async def log_task(self, task_log):
+        self.logs.append(task_log)
+
+    def update_step(self, **kwargs):
+        self.updates.append(kwargs)
+        return SimpleNamespace(status_code=201)
+
+
+class FakePayments:
+    def __init__(self, steps=None):
+        self.ai_protocol = FakeAIProtocol(steps or {})
+
+
+@contextlib.asynccontextmanager
+async def running_worker(agent):
+    task = asyncio.create_task(agent.process_queue())
+    try:
+        yield
+    finally:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    calls = []
+
+    def fake_upload(image, name):
+        calls.append((image, name))
+        return f"https://ipfs.example/{name}"
+
+    monkeypatch.setattr(agent_module, "upload_image_and_get_url", fake_upload)
+    return calls
+
+
+def make_step(step_id, input_query, status=AgentExecutionStatus.Pending.value):
+    return {
+        'step_id': step_id,
+        'task_id': f"task-{step_id}",
+        'step_status': status,
+        'input_query': input_query,
+    }
+
+
+def make_data(step_id):
+    return {'did': 'did:nv:agent', 'task_id': f"task-{step_id}", 'step_id': step_id}
+
+
+async def test_worker_admits_at_most_max_inflight_requests():
+    generator = FakeImageGenerator(max_inflight=2, ticks=3)
+    agent = ImageGeneratorAgent(FakePayments(), generator)
+
+    async with running_worker(agent):
+        images = await asyncio.wait_for(
+            asyncio.gather(*(agent.generate_image(f"character {i}") for i in range(5))), timeout=5
+        )
+
+    assert images == [f"image of character {i}" for i in range(5)]
+    assert max(generator.batch_sizes) == 2
+    assert generator.inflight == []
+
+
+async def test_failed_tick_fails_every_inflight_request_and_worker_recovers():
+    generator = FakeImageGenerator(max_inflight=2)
+    generator.fail_next_step = True
+    agent = ImageGeneratorAgent(FakePayments(), generator)
+
+    async with running_worker(agent):
+        # Queue both before the worker runs, so they start denoising on the same tick
+        first = asyncio.ensure_future(agent.generate_image("first"))
+        second = asyncio.ensure_future(agent.generate_image("second"))
+        results = await asyncio.wait_for(asyncio.gather(first, second, return_exceptions=True), timeout=5)
+
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert generator.inflight == []
+
+        image = await asyncio.wait_for(agent.generate_image("third"), timeout=5)
+
+    assert image == "image of third"
+
+
+async def test_failed_admission_only_fails_that_request():
+    generator = FakeImageGenerator()
+    agent = ImageGeneratorAgent(FakePayments(), generator)
+
+    async with running_worker(agent):
+        bad = asyncio.ensure_future(agent.generate_image("bad"))
+        good = asyncio.ensure_future(agent.generate_image("good"))
+        results = await asyncio.wait_for(asyncio.gather(bad, good, return_exceptions=True), timeout=5)
+
+    assert isinstance(results[0], ValueError)
+    assert results[1] == "image of good"
+
+
+@pytest.mark.parametrize("input_query, expected_prompt", [
+    ('{"name": "Bob", "role": "knight"}  ', "name: Bob\nrole: knight"),
+    ("a tall knight", "a tall knight"),
+    ('{"name": ', '{"name": '),
+    ("[1, 2]", "[1, 2]"),
+])
+async def test_run_builds_character_prompt_from_input_query(uploads, input_query, expected_prompt):
+    payments = FakePayments({'step-1': make_step('step-1', input_query)})
+    generator = FakeImageGenerator()
+    agent = ImageGeneratorAgent(payments, generator)
+
+    async with running_worker(agent):
+        await asyncio.wait_for(agent.run(make_data('step-1')), timeout=5)
+
+    assert generator.prompts == [expected_prompt]
+    update = payments.ai_protocol.updates[0]
+    assert update['step']['step_status'] == AgentExecutionStatus.Completed
+    assert update['step']['output_artifacts'] == ["https://ipfs.example/task-step-1"]
+    assert uploads == [(f"image of {expected_prompt}", "task-step-1")]
+
+
+@pytest.mark.parametrize("input_query", ["", None])
+async def test_run_fails_task_without_character_data(uploads, input_query):
+    payments = FakePayments({'step-1': make_step('step-1', input_query)})
+    generator = FakeImageGenerator()
+    agent = ImageGeneratorAgent(payments, generator)
+
+    await agent.run(make_data('step-1'))
+
+    assert generator.prompts == []
+    assert payments.ai_protocol.updates == []
+    assert payments.ai_protocol.logs[-1].task_status == AgentExecutionStatus.Failed
+
+
+async def test_run_ignores_steps_that_are_not_pending(uploads):
+    step = make_step('step-1', "a knight", status=AgentExecutionStatus.Completed.value)
+    payments = FakePayments({'step-1': step})
+    agent = ImageGeneratorAgent(payments, FakeImageGenerator())
+
+    await agent.run(make_data('step-1'))
+
+    assert payments.ai_protocol.logs == []
+    assert payments.ai_protocol.updates == []
+
+
+async def test_run_reuses_url_for_repeated_character(uploads):
+    payments = FakePayments({
+        'step-1': make_step('step-1', "a knight"),
+        'step-2': make_step('step-2', "a knight"),
+    })
+    generator = FakeImageGenerator()
+    agent = ImageGeneratorAgent(payments, generator)
+
+    async with running_worker(agent):
+        await asyncio.wait_for(agent.run(make_data('step-1')), timeout=5)
+        await asyncio.wait_for(agent.run(make_data('step-2')), timeout=5)
+
+    assert generator.prompts == ["a knight"]
+    assert len(uploads) == 1
+    artifacts = [update['step']['output_artifacts'] for update in payments.ai_protocol.updates]
+    assert artifacts == [["https://ipfs.example/task-step-1"]] * 2
+
+
+async def test_image_cache_evicts_least_recently_used_character(uploads, monkeypatch):
+    monkeypatch.setattr(agent_module, "IMAGE_CACHE_SIZE", 2)
+    queries = ["a", "b", "a", "c", "b"]
+    payments = FakePayments({f"step-{i}": make_step(f"step-{i}", query) for i, query in enumerate(queries)})
+    generator = FakeImageGenerator()
+    agent = ImageGeneratorAgent(payments, generator)
+
+    async with running_worker(agent):
+        for i in range(len(queries)):
+            await asyncio.wait_for(agent.run(make_data(f"step-{i}")), timeout=5)
+
+    # "a" was reused before "c" arrived, so "b" was the one evicted and is generated again
+    assert generator.prompts == ["a", "b", "c", "b"]
@@ -0,0 +1,30 @@
+import pytest
+
+from utils.batching import batch_buckets, bucket_for
+
+
+@pytest.mark.parametrize("max_batch_size, expected", [
+    (1, [1]),
+    (2, [1, 2]),
+    (6, [1, 2, 4, 6]),
+    (8, [1, 2, 4, 8]),
+    (40, [1, 2, 4, 8, 16, 32, 40]),
+])
+def test_batch_buckets_are_powers_of_two_capped_at_max(max_batch_size, expected):
+    assert batch_buckets(max_batch_size) == expected
+
+
+@pytest.mark.parametrize("rows, expected", [
+    (1, 1),
+    (2, 2),
+    (3, 4),
+    (5, 6),
+    (6, 6),
+])
+def test_bucket_for_returns_smallest_fitting_bucket(rows, expected):
+    assert bucket_for(rows, batch_buckets(6)) == expected
+
+
+def test_bucket_for_rejects_rows_above_largest_bucket():
+    with pytest.raises(ValueError):
+        bucket_for(9, batch_buckets(8))
@@ -0,0 +1,35 @@
+def batch_buckets(max_batch_size):
+    """
+    Returns the batch sizes the UNet is specialized for: powers of two up to, and
+    including, the largest batch the stream batch can produce.
+
+    Args:
+        max_batch_size (int): The largest number of UNet rows in a single step.
+
+    Returns:
+        list[int]: The batch sizes, in increasing order.
+    """
+    buckets = []
+    size = 1
+    while size < max_batch_size:
+        buckets.append(size)
+        size *= 2
+    buckets.append(max_batch_size)
+    return buckets
+
+
+def bucket_for(rows, buckets):
+    """
+    Returns the smallest batch size in buckets that fits the given number of rows.
+
+    Args:
+        rows (int): Number of UNet rows in the step.
+        buckets (list[int]): Batch sizes in increasing order.
+
+    Returns:
+        int: The batch size to pad the rows to.
+    """
+    for size in buckets:
+        if size >= rows:
+            return size
+    raise ValueError(f"Batch of {rows} rows exceeds the largest supported batch size {buckets[-1]}")
@@ -1,5 +1,6 @@
+import io
 import os
-from pinatapy import PinataPy
+import requests
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -8,8 +9,23 @@ load_dotenv()
 PINATA_API_KEY = os.getenv('PINATA_API_KEY')
 PINATA_SECRET_API_KEY = os.getenv('PINATA_API_SECRET')
 
-# Connect to Pinata
-pinata = PinataPy(PINATA_API_KEY, PINATA_SECRET_API_KEY)
+# Format used to encode uploaded images: WEBP, JPEG or PNG
+IMAGE_FORMAT = os.getenv('IMAGE_FORMAT', 'WEBP').upper()
+
+# File extension, MIME type and encoder options for each supported image format
+IMAGE_FORMATS = {
+    "WEBP": {"extension": ".webp", "mime_type": "image/webp", "save_options": {"quality": 90, "method": 4}},
+    "JPEG": {"extension": ".jpg", "mime_type": "image/jpeg", "save_options": {"quality": 90}},
+    "PNG": {"extension": ".png", "mime_type": "image/png", "save_options": {"compress_level": 1}},
+}
+
+if IMAGE_FORMAT not in IMAGE_FORMATS:
+    raise ValueError(f"Unsupported IMAGE_FORMAT '{IMAGE_FORMAT}'. Expected one of: {', '.join(IMAGE_FORMATS)}")
+
+PINATA_PIN_FILE_URL = "https://api.pinata.cloud/pinning/pinFileToIPFS"
+
+# Seconds to wait for Pinata to accept a connection and to respond
+PINATA_TIMEOUT = (10, 60)
 
 IPFS_PUBLIC_GATEWAY = "https://gateway.pinata.cloud/ipfs/{CID}"
 
@@ -20,35 +36,62 @@ class IPFSHelper:
     """
 
     @staticmethod
-    def upload_image_to_ipfs(image, filename="image.png"):
+    def upload_image_to_ipfs(image, filename=None, image_format=IMAGE_FORMAT):
         """
         Uploads an image to IPFS through Pinata.
 
         Args:
             image (PIL.Image.Image): The image to upload.
-            filename (str): Name to assign the uploaded image.
+            filename (str): Name to assign the uploaded image. Defaults to 'image' with the
+                extension of the image format.
+            image_format (str): Format to encode the image with ('WEBP', 'JPEG' or 'PNG').
 
         Returns:
             str: The CID (content identifier) of the uploaded image.
         """
-        # Save the image to a temporary file
-        temp_file_path = filename
-        image.save(temp_file_path, format="PNG")
+        format_info = IPFSHelper.get_format_info(image_format)
+        if filename is None:
+            filename = f"image{format_info['extension']}"
+
+        # Encode the image in memory
+        buffer = io.BytesIO()
+        image.save(buffer, format=image_format, **format_info["save_options"])
+        buffer.seek(0)
 
         try:
             # Upload the image to Pinata
             print(f"Uploading {filename} to Pinata...")
-            result = pinata.pin_file_to_ipfs(temp_file_path)
-            cid = result['IpfsHash']
+            response = requests.post(
+                PINATA_PIN_FILE_URL,
+                headers={
+                    "pinata_api_key": PINATA_API_KEY,
+                    "pinata_secret_api_key": PINATA_SECRET_API_KEY,
+                },
+                files={"file": (filename, buffer, format_info["mime_type"])},
+                timeout=PINATA_TIMEOUT,
+            )
+            response.raise_for_status()
+            cid = response.json()['IpfsHash']
 
             print(f"Image uploaded to Pinata. CID: {cid}")
             return cid
         except Exception as e:
             raise Exception(f"Failed to upload image to Pinata: {e}")
-        finally:
-            # Delete the temporary file
-            if os.path.exists(temp_file_path):
-                os.remove(temp_file_path)
+
+    @staticmethod
+    def get_format_info(image_format):
+        """
+        Returns the extension, MIME type and encoder options of a supported image format.
+
+        Args:
+            image_format (str): The image format ('WEBP', 'JPEG' or 'PNG').
+
+        Returns:
+            dict: The format information.
+        """
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"Unsupported image format '{image_format}'. Expected one of: {', '.join(IMAGE_FORMATS)}")
+        return IMAGE_FORMATS[image_format]
 
     @staticmethod
     def get_ipfs_url(cid):
@@ -1,16 +1,19 @@
-from utils.ipfs_helper import IPFSHelper
+from utils.ipfs_helper import IMAGE_FORMAT, IPFSHelper
 
-def upload_image_and_get_url(image, filename="image.png"):
+def upload_image_and_get_url(image, name="image", image_format=IMAGE_FORMAT):
     """
     Uploads an image to IPFS and returns its public URL.
 
     Args:
         image (PIL.Image.Image): The image to upload.
-        filename (str): The filename to use when uploading the image.
+        name (str): The filename to use when uploading the image, without extension. The
+            extension of the image format is appended.
+        image_format (str): Format to encode the image with ('WEBP', 'JPEG' or 'PNG').
 
     Returns:
         str: Public URL of the uploaded image on IPFS.
     """
+    filename = f"{name}{IPFSHelper.get_format_info(image_format)['extension']}"
     print(f"Uploading image to IPFS with filename: {filename}")
-    cid = IPFSHelper.upload_image_to_ipfs(image, filename)
+    cid = IPFSHelper.upload_image_to_ipfs(image, filename, image_format)
     return IPFSHelper.get_ipfs_url(cid)